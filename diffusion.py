@@ -5,7 +5,7 @@ from numba import cuda
 import matplotlib.pyplot as plt
 
 # Use constants and helper functions from kernel_gpu.py
-from kernel_gpu import DTYPE, cx_const, cy_const, w_const
+from kernel_gpu import DTYPE, cx_const, cy_const, w_const, wrap
 
 # Define helper indexing functions
 @cuda.jit(device=True, inline=True)
@@ -40,8 +40,8 @@ def streaming_kernel_periodic(f_in, f_out, nx, ny):
     if i < nx and j < ny:
         for k in range(9):
             # Periodic boundary conditions
-            ip = (i - cx_const[k] + nx) % nx
-            jp = (j - cy_const[k] + ny) % ny
+            ip = wrap(i - cx_const[k], nx)
+            jp = wrap(j - cy_const[k], ny)
             f_out[idx(i, j, k, nx, ny)] = f_in[idx(ip, jp, k, nx, ny)]
 
 @cuda.jit
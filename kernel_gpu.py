@@ -1,9 +1,22 @@
 import numpy as np
-from numba import cuda
+from numba import cuda, from_dtype, void, boolean, int8, int64
 
 # Data type macro
 DTYPE = np.float32  # or np.float64 for double precision
 
+# Thread-block shapes tried by LBMSolverD2Q9GPU.autotune_blockdim(). Blocks are
+# long in x (the contiguous axis) so each warp covers full 128-byte segments.
+BLOCKDIM_CANDIDATES = ((32, 4), (64, 2), (128, 1), (128, 2), (256, 1))
+
+# Storage types of the distribution selectable with LBMSolverD2Q9GPU(precision=...).
+# 'fp16' halves the memory traffic of f; all arithmetic is still done in DTYPE.
+STORAGE_DTYPES = {'fp32': DTYPE, 'fp16': np.float16}
+
+# Rows of the distribution are padded so that each row starts on a boundary of
+# this many bytes (full memory transactions per warp); the pitch in elements
+# therefore depends on the storage type
+ROW_ALIGN_BYTES = 128
+
 #--------------------------------------------------------------------
 # Global constants for D2Q9 (Python tuples are accessible inside JITed kernels)
 #--------------------------------------------------------------------
@@ -12,165 +25,442 @@ cy_const = (0,  0,  1,  0, -1,  1,  1, -1, -1)
 w_const  = tuple(DTYPE(w) for w in (4.0/9.0, 1.0/9.0, 1.0/9.0, 1.0/9.0, 1.0/9.0,
                                    1.0/36.0, 1.0/36.0, 1.0/36.0, 1.0/36.0))
 
+# Array copies of the tables; kernels place them in __constant__ memory with
+# cuda.const.array_like so a warp reading the same k is served by one broadcast
+cx_arr  = np.array(cx_const, dtype=np.int32)
+cy_arr  = np.array(cy_const, dtype=np.int32)
+
 #--------------------------------------------------------------------
-# CUDA kernel: Collision Step
-# Each lattice cell computes its density, velocity, and then relaxes toward equilibrium.
+# Kernel signatures. cuda.jit does not accept cache=True; passing explicit
+# signatures compiles the kernels up front instead of on first launch and skips
+# argument-type dispatch on every launch. The solver kernels are compiled when a
+# solver is constructed (aa_kernels(), solver_kernels()), only for its storage
+# type, so importing this module for its constants needs no GPU.
+# '::1' marks the contiguous axis.
 #--------------------------------------------------------------------
-@cuda.jit(fastmath=True)
-def collision_kernel(f, omega, nx, ny):
-    i, j = cuda.grid(2)
-    if i < nx and j < ny:
-        rho = 0.0
-        u_x = 0.0
-        u_y = 0.0
-        # Compute macroscopic density and momentum from distribution functions
-        for k in range(9):
-            val = f[i, j, k]
-            rho += val
-            u_x += val * cx_const[k]
-            u_y += val * cy_const[k]
-        if rho > 0.0:
-            u_x /= rho
-            u_y /= rho
-        usqr = u_x*u_x + u_y*u_y
-        # Relaxation (BGK collision) toward equilibrium
-        for k in range(9):
-            cu = 3.0 * (cx_const[k] * u_x + cy_const[k] * u_y)
-            feq = w_const[k] * rho * (1.0 + cu + 0.5 * cu * cu - 1.5 * usqr)
-            f[i, j, k] = (1.0 - omega) * f[i, j, k] + omega * feq
+real = from_dtype(np.dtype(DTYPE))
+field3d = real[:, :, ::1]   # distribution f[k, j, i]
+mask2d = int8[:, ::1]       # solid mask[j, i]
+
+# Typed literals: a bare 1.0 is float64 in Numba and would promote the whole
+# collision to double precision
+ONE, HALF, ONE_HALF, THREE = (DTYPE(v) for v in (1.0, 0.5, 1.5, 3.0))
+SIXTH = DTYPE(1.0/6.0)
 
 #--------------------------------------------------------------------
-# CUDA kernel: Streaming Step
-# For interior nodes, each lattice cell “pulls” data from its neighbors.
-# Boundary nodes are simply copied (their distributions will be corrected by BC kernels).
+# Single-array AA streaming pattern
+# Only one copy of f is kept. Steps alternate between two kernels so that every
+# thread reads and writes the same memory locations, which makes the update
+# safe in place:
+#   even step: read the streamed populations of node x from f[k, x], collide
+#              and write them back to the same node in the opposite slots,
+#              f[opp(k), x]
+#   odd step:  gather the streamed populations of x from the opposite slots of
+#              its upwind neighbours, f[opp(k), x - c_k], collide and push them
+#              to f[k, x + c_k]
+# After an odd step f is back in natural order. As before, boundary nodes
+# (i = 0, nx-1, j = 0, ny-1) do not receive from their neighbours but keep their
+# own values. Bounce-back (mask) and the moving lid (top row j = ny - 2) are
+# applied to the streamed populations of a node right before its collision.
+# Every population is read exactly once per step (by its own cell), so there is
+# no neighbour reuse for a shared-memory halo tile to exploit; loads are already
+# coalesced through the [k, j, i] layout.
 #--------------------------------------------------------------------
-@cuda.jit
-def streaming_kernel(f_in, f_out, nx, ny):
-    i, j = cuda.grid(2)
-    if i < nx and j < ny:
-        # For interior nodes, perform streaming using the opposite direction.
+@cuda.jit(device=True, inline=True)
+def apply_boundary(f0, f1, f2, f3, f4, f5, f6, f7, f8, solid, lid, U):
+    """Bounce-back at solid nodes, then the moving lid on the lid row"""
+    if solid:
+        f1, f3 = f3, f1
+        f2, f4 = f4, f2
+        f5, f7 = f7, f5
+        f6, f8 = f8, f6
+    if lid:
+        # Ladd link-based velocity boundary condition
+        f4 = f2
+        f7 = f5 - SIXTH * U
+        f8 = f6 + SIXTH * U
+    return f0, f1, f2, f3, f4, f5, f6, f7, f8
+
+@cuda.jit(device=True, inline=True)
+def collide(f0, f1, f2, f3, f4, f5, f6, f7, f8, omega):
+    """BGK relaxation of the populations of one node toward equilibrium"""
+    # Compute macroscopic density and momentum from distribution functions.
+    # These are plain register adds (cx, cy are 0/+-1): about 20 FP32 ops per node
+    # against 36-72 bytes of traffic, so they are not worth routing through
+    # tensor-core (WMMA) tiles, which Numba does not expose anyway.
+    rho = f0 + f1 + f2 + f3 + f4 + f5 + f6 + f7 + f8
+    u_x = f1 - f3 + f5 - f6 - f7 + f8
+    u_y = f2 - f4 + f5 + f6 - f7 - f8
+    # rho is a sum of nine positive populations and stays > 0 in any stable
+    # run, so no guard: one reciprocal (rcp.approx under fastmath) replaces a
+    # divergent branch and two divisions.
+    inv_rho = ONE / rho
+    u_x = u_x * inv_rho
+    u_y = u_y * inv_rho
+    usqr = u_x*u_x + u_y*u_y
+    feq_base = ONE - ONE_HALF * usqr
+
+    # Relaxation (BGK collision) toward equilibrium
+    c1 = ONE - omega
+    cu = THREE * u_x
+    f1 = c1 * f1 + omega * (w_const[1] * rho * (feq_base + cu + HALF * cu * cu))
+    f3 = c1 * f3 + omega * (w_const[3] * rho * (feq_base - cu + HALF * cu * cu))
+    cu = THREE * u_y
+    f2 = c1 * f2 + omega * (w_const[2] * rho * (feq_base + cu + HALF * cu * cu))
+    f4 = c1 * f4 + omega * (w_const[4] * rho * (feq_base - cu + HALF * cu * cu))
+    cu = THREE * (u_x + u_y)
+    f5 = c1 * f5 + omega * (w_const[5] * rho * (feq_base + cu + HALF * cu * cu))
+    f7 = c1 * f7 + omega * (w_const[7] * rho * (feq_base - cu + HALF * cu * cu))
+    cu = THREE * (u_y - u_x)
+    f6 = c1 * f6 + omega * (w_const[6] * rho * (feq_base + cu + HALF * cu * cu))
+    f8 = c1 * f8 + omega * (w_const[8] * rho * (feq_base - cu + HALF * cu * cu))
+    f0 = c1 * f0 + omega * (w_const[0] * rho * feq_base)
+    return f0, f1, f2, f3, f4, f5, f6, f7, f8
+
+@cuda.jit(device=True, inline=True)
+def load_natural(f, i, j):
+    """Populations of node (i, j) stored in natural order (after an odd step),
+    converted from the storage type to DTYPE"""
+    return (real(f[0, j, i]), real(f[1, j, i]), real(f[2, j, i]),
+            real(f[3, j, i]), real(f[4, j, i]), real(f[5, j, i]),
+            real(f[6, j, i]), real(f[7, j, i]), real(f[8, j, i]))
+
+@cuda.jit(device=True, inline=True)
+def load_swapped(f, i, j, nx, ny):
+    """Streamed populations of node (i, j) while f holds swapped post-collision
+    values (after an even step): pulled from the upwind neighbours for interior
+    nodes, from the node itself for boundary nodes"""
+    if (i > 0) and (i < nx - 1) and (j > 0) and (j < ny - 1):
+        return (real(f[0, j, i]), real(f[3, j, i - 1]), real(f[4, j - 1, i]),
+                real(f[1, j, i + 1]), real(f[2, j + 1, i]), real(f[7, j - 1, i - 1]),
+                real(f[8, j - 1, i + 1]), real(f[5, j + 1, i + 1]), real(f[6, j + 1, i - 1]))
+    return (real(f[0, j, i]), real(f[3, j, i]), real(f[4, j, i]),
+            real(f[1, j, i]), real(f[2, j, i]), real(f[7, j, i]),
+            real(f[8, j, i]), real(f[5, j, i]), real(f[6, j, i]))
+
+@cuda.jit(device=True, inline=True)
+def push_interior(f, i, j, nx, ny, f1, f2, f3, f4, f5, f6, f7, f8):
+    """Write the post-collision populations of (i, j) to its interior neighbours"""
+    # Is column/row i-1, i, i+1 (j-1, j, j+1) interior?
+    xm = i > 1
+    x0 = (i > 0) and (i < nx - 1)
+    xp = i < nx - 2
+    ym = j > 1
+    y0 = (j > 0) and (j < ny - 1)
+    yp = j < ny - 2
+    if xp and y0:
+        f[1, j, i + 1] = f1
+    if x0 and yp:
+        f[2, j + 1, i] = f2
+    if xm and y0:
+        f[3, j, i - 1] = f3
+    if x0 and ym:
+        f[4, j - 1, i] = f4
+    if xp and yp:
+        f[5, j + 1, i + 1] = f5
+    if xm and yp:
+        f[6, j + 1, i - 1] = f6
+    if xm and ym:
+        f[7, j - 1, i - 1] = f7
+    if xp and ym:
+        f[8, j - 1, i + 1] = f8
+
+#--------------------------------------------------------------------
+# AA step kernels specialized for one (nx, ny, omega, U)
+# These are fixed for a run, so they are baked into the kernels as compile-time
+# constants (Numba freezes closure variables): 1 - omega and U/6 fold into
+# immediates, neighbour and ring index arithmetic uses literal sizes, and the
+# bounds checks vanish when the launch grid tiles the domain exactly.
+# Compiled kernels are cached per specialization.
+#--------------------------------------------------------------------
+_aa_kernel_cache = {}
+
+def step_signature(storage_dtype):
+    """Signature of the AA step kernels for f stored as storage_dtype"""
+    return void(from_dtype(np.dtype(storage_dtype))[:, :, ::1], mask2d)
+
+def aa_kernels(nx, ny, blockdim, omega, U, storage_dtype=DTYPE):
+    """
+    Return the (even, odd, odd_ring) AA step kernels for an nx x ny domain
+    launched with blocks of shape blockdim, compiling them on first use.
+    nx, ny, omega and U are compile-time constants of the kernels. When the
+    launch grid tiles the domain exactly the bounds checks are compiled out.
+    Only the overload for f stored as storage_dtype is compiled.
+    """
+    storage_dtype = np.dtype(storage_dtype)
+    nx = int(nx)
+    ny = int(ny)
+    omega = DTYPE(omega)
+    U = DTYPE(U)
+    bx, by = blockdim
+    tiled = nx % bx == 0 and ny % by == 0
+    ring_tiled = (2 * nx + 2 * (ny - 2)) % (bx * by) == 0
+    # blockdim only affects the code through the tiling flags
+    key = (storage_dtype, nx, ny, tiled, ring_tiled, omega, U)
+    if key in _aa_kernel_cache:
+        return _aa_kernel_cache[key]
+
+    sig = step_signature(storage_dtype)
+
+    # AA even step (purely node-local, in place)
+    @cuda.jit(sig, fastmath=True)
+    def aa_even_kernel(f, mask):
+        i, j = cuda.grid(2)
+        if tiled or (i < nx and j < ny):
+            f0, f1, f2, f3, f4, f5, f6, f7, f8 = load_natural(f, i, j)
+            f0, f1, f2, f3, f4, f5, f6, f7, f8 = apply_boundary(
+                f0, f1, f2, f3, f4, f5, f6, f7, f8, mask[j, i] == 1, j == ny - 2, U)
+            f0, f1, f2, f3, f4, f5, f6, f7, f8 = collide(
+                f0, f1, f2, f3, f4, f5, f6, f7, f8, omega)
+            # Write back with opposite directions swapped
+            f[0, j, i] = f0
+            f[3, j, i] = f1
+            f[4, j, i] = f2
+            f[1, j, i] = f3
+            f[2, j, i] = f4
+            f[7, j, i] = f5
+            f[8, j, i] = f6
+            f[5, j, i] = f7
+            f[6, j, i] = f8
+
+    # AA odd step
+    # Interior nodes and the boundary ring are updated by two launches: a ring node
+    # reads its own slots, which its interior neighbour also reads, so the ring may
+    # only overwrite them once the interior launch has completed.
+    @cuda.jit(sig, fastmath=True)
+    def aa_odd_kernel(f, mask):
+        i, j = cuda.grid(2)
         if (i > 0) and (i < nx - 1) and (j > 0) and (j < ny - 1):
-            for k in range(9):
-                ip = i - cx_const[k]
-                jp = j - cy_const[k]
-                f_out[i, j, k] = f_in[ip, jp, k]
-        else:
-            # For boundary nodes, simply copy the current value.
-            for k in range(9):
-                f_out[i, j, k] = f_in[i, j, k]
+            f0, f1, f2, f3, f4, f5, f6, f7, f8 = load_swapped(f, i, j, nx, ny)
+            f0, f1, f2, f3, f4, f5, f6, f7, f8 = apply_boundary(
+                f0, f1, f2, f3, f4, f5, f6, f7, f8, mask[j, i] == 1, j == ny - 2, U)
+            f0, f1, f2, f3, f4, f5, f6, f7, f8 = collide(
+                f0, f1, f2, f3, f4, f5, f6, f7, f8, omega)
+            f[0, j, i] = f0
+            push_interior(f, i, j, nx, ny, f1, f2, f3, f4, f5, f6, f7, f8)
+
+    @cuda.jit(sig, fastmath=True)
+    def aa_odd_ring_kernel(f, mask):
+        n = cuda.grid(1)  # index along the boundary ring
+        if ring_tiled or n < 2 * nx + 2 * (ny - 2):
+            if n < nx:
+                i = n
+                j = 0
+            elif n < 2 * nx:
+                i = n - nx
+                j = ny - 1
+            elif n < 2 * nx + ny - 2:
+                i = 0
+                j = n - 2 * nx + 1
+            else:
+                i = nx - 1
+                j = n - 2 * nx - (ny - 2) + 1
+            f0, f1, f2, f3, f4, f5, f6, f7, f8 = load_swapped(f, i, j, nx, ny)
+            f0, f1, f2, f3, f4, f5, f6, f7, f8 = apply_boundary(
+                f0, f1, f2, f3, f4, f5, f6, f7, f8, mask[j, i] == 1, j == ny - 2, U)
+            f0, f1, f2, f3, f4, f5, f6, f7, f8 = collide(
+                f0, f1, f2, f3, f4, f5, f6, f7, f8, omega)
+            # Boundary nodes keep their own values
+            f[0, j, i] = f0
+            f[1, j, i] = f1
+            f[2, j, i] = f2
+            f[3, j, i] = f3
+            f[4, j, i] = f4
+            f[5, j, i] = f5
+            f[6, j, i] = f6
+            f[7, j, i] = f7
+            f[8, j, i] = f8
+            push_interior(f, i, j, nx, ny, f1, f2, f3, f4, f5, f6, f7, f8)
 
-@cuda.jit
+    _aa_kernel_cache[key] = (aa_even_kernel, aa_odd_kernel, aa_odd_ring_kernel)
+    return _aa_kernel_cache[key]
+
+@cuda.jit(device=True, inline=True)
+def wrap(i, n):
+    """Periodic wrap of an index at most one cell outside [0, n), without the
+    integer modulo (compiles to compare + select)"""
+    return i + n if i < 0 else (i - n if i >= n else i)
+
+# Kernel bodies; compiled per storage type by solver_kernels() below
 def streaming_kernel_periodic(f_in, f_out, nx, ny):
+    cx = cuda.const.array_like(cx_arr)
+    cy = cuda.const.array_like(cy_arr)
     i, j = cuda.grid(2)
     if i < nx and j < ny:
         for k in range(9):
-            ip = (i - cx_const[k] + nx) % nx
-            jp = (j - cy_const[k] + ny) % ny
-            f_out[i, j, k] = f_in[ip, jp, k]
+            ip = wrap(i - cx[k], nx)
+            jp = wrap(j - cy[k], ny)
+            f_out[k, j, i] = f_in[k, jp, ip]
 
 #--------------------------------------------------------------------
-# CUDA kernel: Bounce-Back on Left, Right, and Bottom Walls
-# A simple (local) bounce-back that swaps populations for wall nodes.
+# CUDA kernels: diagnostics
+# Both reconstruct the post-boundary populations of each node from the AA
+# storage (odd = f holds the swapped values of an even step).
 #--------------------------------------------------------------------
-@cuda.jit
-def bounce_back_kernel(f, mask, nx, ny):
+@cuda.jit(device=True, inline=True)
+def load_state(f, mask, U, i, j, nx, ny, odd):
+    """Streamed populations of node (i, j) with the boundary conditions applied"""
+    if odd:
+        f0, f1, f2, f3, f4, f5, f6, f7, f8 = load_swapped(f, i, j, nx, ny)
+    else:
+        f0, f1, f2, f3, f4, f5, f6, f7, f8 = load_natural(f, i, j)
+    return apply_boundary(f0, f1, f2, f3, f4, f5, f6, f7, f8,
+                          mask[j, i] == 1, j == ny - 2, U)
+
+def distribution_kernel(f, f_out, mask, U, nx, ny, odd):
     i, j = cuda.grid(2)
     if i < nx and j < ny:
-        # Apply bounce-back on left (i==0), right (i==nx-1) and bottom (j==0)
-        #if (i == 0) or (i == nx - 1) or (j == 0) or (j == ny - 1):
-        #if (i == 1) or (i == nx - 2) or (j == 1):
-        
-        # Apply bounce-back at solid node:
-        if mask[i, j] == 1:
-            # Swap east (1) and west (3)
-            tmp = f[i, j, 1]
-            f[i, j, 1] = f[i, j, 3]
-            f[i, j, 3] = tmp
-            # Swap north (2) and south (4)
-            tmp = f[i, j, 2]
-            f[i, j, 2] = f[i, j, 4]
-            f[i, j, 4] = tmp
-            # Swap north-east (5) and south-west (7)
-            tmp = f[i, j, 5]
-            f[i, j, 5] = f[i, j, 7]
-            f[i, j, 7] = tmp
-            # Swap north-west (6) and south-east (8)
-            tmp = f[i, j, 6]
-            f[i, j, 6] = f[i, j, 8]
-            f[i, j, 8] = tmp
+        f0, f1, f2, f3, f4, f5, f6, f7, f8 = load_state(f, mask, U, i, j, nx, ny, odd)
+        f_out[0, j, i] = f0
+        f_out[1, j, i] = f1
+        f_out[2, j, i] = f2
+        f_out[3, j, i] = f3
+        f_out[4, j, i] = f4
+        f_out[5, j, i] = f5
+        f_out[6, j, i] = f6
+        f_out[7, j, i] = f7
+        f_out[8, j, i] = f8
 
-#--------------------------------------------------------------------
-# CUDA kernel: Moving-Lid Boundary Condition on Top Wall
-# At the top boundary (j = ny - 1), we enforce a velocity U in the x-direction.
-# We first “reflect” the unknown populations and then add a momentum correction.
-#--------------------------------------------------------------------
-@cuda.jit
-def moving_lid_kernel(f, nx, ny, U):
-    i = cuda.grid(1)  # iterate along x only
-    if i < nx:
-        #if i != 1 or i != nx - 2:
-            j = ny - 2        # top row
-            
-            # Zou-He wet node velocity boundary condition
-            # rho = f[i, j, 0] + f[i, j, 1] + f[i, j, 3] + 2.0 * (f[i, j, 2] + f[i, j, 5] + f[i, j, 6])
-            # f[i, j, 4] = f[i, j, 2]
-            # f[i, j, 7] = f[i, j, 5] + 0.5 * (f[i, j, 1] - f[i, j, 3]) - 0.5 * rho * U
-            # f[i, j, 8] = f[i, j, 6] - 0.5 * (f[i, j, 1] - f[i, j, 3]) + 0.5 * rho * U
-            
-            # Ladd Link-based velocity boundary condition
-            f[i, j, 4] = f[i, j, 2] 
-            f[i, j, 7] = f[i, j, 5] - 1.0/6.0 * U
-            f[i, j, 8] = f[i, j, 6] + 1.0/6.0 * U
-            
-@cuda.jit(fastmath=True)
-def compute_macro(f, nx, ny, rho, ux, uy):
+def compute_macro(f, mask, U, nx, ny, odd, macro):
     i, j = cuda.grid(2)
     if i < nx and j < ny:
-        rho_v = 0.0
-        u_x_v = 0.0
-        u_y_v = 0.0
+        f0, f1, f2, f3, f4, f5, f6, f7, f8 = load_state(f, mask, U, i, j, nx, ny, odd)
         # Compute macroscopic density and momentum from distribution functions
-        for k in range(9):
-            val = f[i, j, k]
-            rho_v += val
-            u_x_v += val * cx_const[k]
-            u_y_v += val * cy_const[k]
+        rho_v = f0 + f1 + f2 + f3 + f4 + f5 + f6 + f7 + f8
+        u_x_v = f1 - f3 + f5 - f6 - f7 + f8
+        u_y_v = f2 - f4 + f5 + f6 - f7 - f8
         if rho_v > 0.0:
             u_x_v /= rho_v
             u_y_v /= rho_v
-        rho[i, j] = rho_v
-        ux[i, j] = u_x_v
-        uy[i, j] = u_y_v
+        # macro[0..2, j, i] = rho, ux, uy (i contiguous for coalesced stores)
+        macro[0, j, i] = rho_v
+        macro[1, j, i] = u_x_v
+        macro[2, j, i] = u_y_v
+
+_solver_kernel_cache = {}
+
+def solver_kernels(storage_dtype=DTYPE):
+    """
+    Return the (streaming_kernel_periodic, distribution_kernel, compute_macro)
+    kernels for f stored as storage_dtype, compiling them on first use.
+    """
+    storage_dtype = np.dtype(storage_dtype)
+    if storage_dtype not in _solver_kernel_cache:
+        f = from_dtype(storage_dtype)[:, :, ::1]
+        _solver_kernel_cache[storage_dtype] = (
+            cuda.jit(void(f, f, int64, int64))(streaming_kernel_periodic),
+            cuda.jit(void(f, f, mask2d, real, int64, int64, boolean))(distribution_kernel),
+            cuda.jit(void(f, mask2d, real, int64, int64, boolean, field3d),
+                     fastmath=True)(compute_macro))
+    return _solver_kernel_cache[storage_dtype]
 
 class LBMSolverD2Q9GPU:
-    def __init__(self, nx, ny, omega, U):
+    def __init__(self, nx, ny, omega, U, precision='fp32'):
         self.nx = nx
         self.ny = ny
         self.omega = DTYPE(omega)
         self.U = DTYPE(U)
+        self.precision = precision
+        self.storage_dtype = STORAGE_DTYPES[precision]
+        self.solver_kernels = solver_kernels(self.storage_dtype)
+        # Row pitch of the device fields (padding columns i >= nx are never touched)
+        row_align = ROW_ALIGN_BYTES // np.dtype(self.storage_dtype).itemsize
+        self.nx_pad = (nx + row_align - 1)//row_align*row_align
 
         # Allocate device memory for distribution function
-        self.f = cuda.device_array((nx, ny, 9), dtype=DTYPE)
-        self.f_new = cuda.device_array((nx, ny, 9), dtype=DTYPE)
-        
-        # Allocate device memory for macroscopic fields
-        self.rho = cuda.device_array((nx, ny), dtype=DTYPE)
-        self.ux = cuda.device_array((nx, ny), dtype=DTYPE)
-        self.uy = cuda.device_array((nx, ny), dtype=DTYPE)
+        # Structure-of-arrays layout f[k, j, i]: i is the contiguous axis, so
+        # neighbouring threads along x access consecutive words of each population.
+        # A single array is updated in place with the AA pattern; self.odd is True
+        # after an odd number of steps, when f holds swapped post-collision values.
+        self.f = cuda.device_array((9, ny, self.nx_pad), dtype=self.storage_dtype)
+        self.odd = False
         
-        # Allocate device memory for mask
-        self.mask = cuda.device_array((nx, ny), dtype=np.int8)
+        # Allocate device memory for macroscopic fields: rho, ux, uy packed in one
+        # [3, j, i] array so they come back in a single transfer
+        self.macro = cuda.device_array((3, ny, nx), dtype=DTYPE)
+
+        # Pinned host buffer for the diagnostic copies (DMA-able, truly async)
+        self.h_macro = cuda.pinned_array((3, ny, nx), dtype=DTYPE)
+
+        # Allocate device memory for mask (indexed [j, i] like f)
+        self.mask = cuda.device_array((ny, self.nx_pad), dtype=np.int8)
+
+        # All kernels run on a dedicated stream; diagnostic device-to-host copies
+        # run on a second one so they can overlap with the following steps
+        self.stream = cuda.stream()
+        self.copy_stream = cuda.stream()
+        self.copy_done = None  # event recorded after the last diagnostic copy
+
+        # Choose thread-block dimensions (long in x for coalesced SoA accesses)
+        self.set_blockdim((128, 2))
+
+    def set_blockdim(self, blockdim):
+        """
+        Set the thread-block shape and the matching grid size.
+        """
+        self.blockdim = tuple(blockdim)
+        self.griddim = ((self.nx + self.blockdim[0] - 1)//self.blockdim[0],
+                        (self.ny + self.blockdim[1] - 1)//self.blockdim[1])
+        # 1D launch over the boundary ring for the odd AA step
+        self.ring_blockdim = self.blockdim[0] * self.blockdim[1]
+        n_ring = 2 * self.nx + 2 * (self.ny - 2)
+        self.ring_griddim = (n_ring + self.ring_blockdim - 1)//self.ring_blockdim
+        # The step kernels are specialized on the launch shape as well
+        self.kernels = aa_kernels(self.nx, self.ny, self.blockdim, self.omega, self.U,
+                                  self.storage_dtype)
+
+    def set_parameters(self, omega, U):
+        """
+        Change the relaxation rate and lid velocity; the step kernels are
+        specialized for these values, so they are looked up (or compiled) again.
+        """
+        self.omega = DTYPE(omega)
+        self.U = DTYPE(U)
+        self.kernels = aa_kernels(self.nx, self.ny, self.blockdim, self.omega, self.U,
+                                  self.storage_dtype)
+
+    def autotune_blockdim(self, candidates=BLOCKDIM_CANDIDATES, num_steps=50):
+        """
+        Time num_steps steps for every candidate block shape and keep the fastest.
+        The distribution is restored afterwards, so call this once the solver is
+        initialized and the mask is set. Returns the chosen block shape.
+        """
+        f_backup = cuda.device_array_like(self.f)
+        f_backup.copy_to_device(self.f, stream=self.stream)
+        odd_backup = self.odd
+
+        device = cuda.get_current_device()
+        print(f"Device {device.name}, "
+              f"compute capability {device.compute_capability}")
+        sig = step_signature(self.storage_dtype)
+
+        start, end = cuda.event(), cuda.event()
+        timings = {}
+        for blockdim in candidates:
+            self.set_blockdim(blockdim)
+            # set_blockdim() may have swapped in differently specialized kernels
+            regs = max(kernel.get_regs_per_thread(sig) for kernel in self.kernels)
+            self.run(2)  # warm-up
+            start.record(self.stream)
+            self.run(num_steps)
+            end.record(self.stream)
+            end.synchronize()
+            timings[self.blockdim] = start.elapsed_time(end)
+            threads = self.blockdim[0] * self.blockdim[1]
+            print(f"  blockdim {self.blockdim}: {timings[self.blockdim]/num_steps:.4f} ms/step, "
+                  f"{regs} registers/thread, {regs * threads} registers/block")
+
+        self.set_blockdim(min(timings, key=timings.get))
+        self.f.copy_to_device(f_backup, stream=self.stream)
+        self.odd = odd_backup
+        print(f"Selected blockdim {self.blockdim}")
+        return self.blockdim
 
-        # Choose thread-block dimensions
-        self.blockdim = (16, 16)
-        self.griddim = ((nx + self.blockdim[0] - 1)//self.blockdim[0],
-                        (ny + self.blockdim[1] - 1)//self.blockdim[1])
-        
     def set_mask(self):
         """
         define a mask for the solid boundary
         """
-        mask_host = np.zeros((self.nx, self.ny), dtype=np.int8)
+        mask_host = np.zeros((self.ny, self.nx_pad), dtype=np.int8)
 
         # define a circle in the center of the domain
         # cx, cy = self.nx // 2, self.ny // 2
@@ -179,29 +469,33 @@ class LBMSolverD2Q9GPU:
         #     for j in range(self.ny):
         #         dist2 = (i - cx)**2 + (j - cy)**2
         #         if dist2 < r*r:
-        #             mask_host[i, j] = 1
+        #             mask_host[j, i] = 1
         
         # define a open-lid square
-        for i in range(self.nx):
-            for j in range(self.ny):
-                if i == 1 or i == self.nx - 2 or j == 1:
-                    mask_host[i, j] = 1
+        mask_host[:, 1] = 1
+        mask_host[:, self.nx - 2] = 1
+        mask_host[1, :self.nx] = 1
 
         # copy to device
-        self.mask.copy_to_device(mask_host)
+        self.mask.copy_to_device(mask_host, stream=self.stream)
 
     def initialize(self, rho0=1.0, u0x=0.1, u0y=0.0):
         """
         Initialize the distribution on the CPU, then copy to GPU.
         """
-        f_host = np.zeros((self.nx, self.ny, 9), dtype=DTYPE)
+        # Page-locked staging buffer, so the upload is a full-speed DMA on the
+        # solver stream. It is only needed until that copy completes.
+        f_host = cuda.pinned_array((9, self.ny, self.nx_pad), dtype=self.storage_dtype)
+        f_host[:, :, self.nx:] = 0
 
-        for i in range(self.nx):
-            for j in range(self.ny):
-                usq = u0x*u0x + u0y*u0y
-                for k in range(9):
-                    cu = 3.0*(cx_const[k]*u0x + cy_const[k]*u0y)
-                    f_host[i, j, k] = w_const[k]*rho0*(1.0 + cu + 0.5*cu*cu - 1.5*usq)
+        # Uniform equilibrium: one value per direction, broadcast over the grid
+        cx = np.array(cx_const, dtype=DTYPE)
+        cy = np.array(cy_const, dtype=DTYPE)
+        w = np.array(w_const, dtype=DTYPE)
+        usq = u0x*u0x + u0y*u0y
+        cu = 3.0*(cx*u0x + cy*u0y)
+        feq = w*rho0*(1.0 + cu + 0.5*cu*cu - 1.5*usq)
+        f_host[:, :, :self.nx] = feq[:, None, None]
 
         # for j in range(self.ny):
         #     if j != 1 or j != self.ny - 2:
@@ -209,74 +503,92 @@ class LBMSolverD2Q9GPU:
         #         usq = self.U*self.U
         #         for k in range(9):
         #             cu = 3.0*(cx_const[k]*self.U)
-        #             f_host[i, j, k] = w_const[k]*rho0*(1.0 + cu + 0.5*cu*cu - 1.5*usq)
+        #             f_host[k, j, i] = w_const[k]*rho0*(1.0 + cu + 0.5*cu*cu - 1.5*usq)
             
-        self.f.copy_to_device(f_host)
+        self.f.copy_to_device(f_host, stream=self.stream)
+        self.stream.synchronize()  # f_host is freed on return
+        self.odd = False
 
     def step(self):
         """
-        Perform one LBM timestep:
-          1) collision (in-place)
-          2) streaming (f -> f_new)
-          3) bounce-back on f_new
-          4) swap f and f_new
+        Perform one LBM timestep in place (AA pattern): collision, streaming,
+        bounce-back and the moving lid. Even and odd steps use different kernels.
         """
-        # 1) Collision in-place on self.f
-        collision_kernel[self.griddim, self.blockdim](self.f, self.omega,
-                                                      self.nx, self.ny)
-        #cuda.synchronize()
-
-        # 2) Streaming: f -> f_new
-        streaming_kernel[self.griddim, self.blockdim](self.f, self.f_new,
-                                                      self.nx, self.ny)
-        #cuda.synchronize()
-        
-        # 2) Streaming with periodic boundary conditions
-        # streaming_kernel_periodic[self.griddim, self.blockdim](self.f, self.f_new,
-        #                                               self.nx, self.ny)
-        # cuda.synchronize()
-
-        # 3) Bounce-back on f_new
-        bounce_back_kernel[self.griddim, self.blockdim](self.f_new, self.mask,
-                                                        self.nx, self.ny)
-        #cuda.synchronize()
-        
-        # 4) Moving-lid boundary condition on top wall
-        moving_lid_kernel[self.griddim, self.blockdim](self.f_new, self.nx, self.ny, self.U)
-        #cuda.synchronize()
-
-        # 5) Swap
-        self.f, self.f_new = self.f_new, self.f
+        aa_even_kernel, aa_odd_kernel, aa_odd_ring_kernel = self.kernels
+        if not self.odd:
+            aa_even_kernel[self.griddim, self.blockdim, self.stream](self.f, self.mask)
+        else:
+            aa_odd_kernel[self.griddim, self.blockdim, self.stream](self.f, self.mask)
+            aa_odd_ring_kernel[self.ring_griddim, self.ring_blockdim, self.stream](
+                self.f, self.mask)
+        self.odd = not self.odd
 
     def stream_periodic(self):
-        # Streaming with periodic boundary conditions
-        streaming_kernel_periodic[self.griddim, self.blockdim](self.f, self.f_new,
+        # Streaming with periodic boundary conditions (needs f in natural order)
+        assert not self.odd, "stream_periodic requires an even number of steps"
+        f_new = cuda.device_array_like(self.f)
+        streaming_kernel_periodic = self.solver_kernels[0]
+        streaming_kernel_periodic[self.griddim, self.blockdim, self.stream](self.f, f_new,
                                                       self.nx, self.ny)
-        cuda.synchronize()
-        # Swap
-        self.f, self.f_new = self.f_new, self.f
+        self.f = f_new
 
 
     def run(self, num_steps=1000):
         """
         Run LBM for num_steps timesteps.
+        Kernels are queued asynchronously on the solver stream (which already
+        executes them in order); the host only waits once all steps are issued.
         """
         for _ in range(num_steps):
             self.step()
+        self.stream.synchronize()
 
     def get_distribution(self):
         """
-        Copy the current distribution f from device to host.
+        Copy the current distribution f from device to host (layout [k, j, i]),
+        with the boundary conditions applied.
         """
-        return self.f.copy_to_host()
+        f_out = cuda.device_array_like(self.f)
+        distribution_kernel = self.solver_kernels[1]
+        distribution_kernel[self.griddim, self.blockdim, self.stream](self.f, f_out, self.mask,
+                                                                      self.U, self.nx, self.ny,
+                                                                      self.odd)
+        f_host = f_out.copy_to_host(stream=self.stream)
+        self.stream.synchronize()
+        return f_host[:, :, :self.nx]
+
+    def compute_macroscopic_async(self):
+        """
+        Queue the computation of density and velocity and their copy to the host
+        without waiting for it. Returns (event, (rho, ux, uy)): call
+        event.synchronize() before reading the arrays. The copies run on their
+        own stream, so steps queued afterwards overlap with the transfer. The
+        arrays are views of a pinned buffer that is reused by the next call.
+        """
+        # Do not overwrite the device fields while a previous copy still reads them
+        if self.copy_done is not None:
+            self.copy_done.wait(self.stream)
+        compute_macro = self.solver_kernels[2]
+        compute_macro[self.griddim, self.blockdim, self.stream](self.f, self.mask, self.U,
+                                                                self.nx, self.ny, self.odd,
+                                                                self.macro)
+        computed = cuda.event()
+        computed.record(self.stream)
+        computed.wait(self.copy_stream)
+        self.macro.copy_to_host(self.h_macro, stream=self.copy_stream)
+        self.copy_done = cuda.event()
+        self.copy_done.record(self.copy_stream)
+        # Transposed views, indexed [i, j]
+        return self.copy_done, (self.h_macro[0].T, self.h_macro[1].T, self.h_macro[2].T)
 
     def compute_macroscopic(self):
         """
-        Optionally compute density and velocity on the host after copying f.
+        Compute density and velocity on the GPU and copy them to the host.
+        Each field is returned as an (nx, ny) array indexed [i, j].
         """
-        compute_macro[self.griddim, self.blockdim](self.f, self.nx, self.ny,
-                                                    self.rho, self.ux, self.uy)
-        return self.rho.copy_to_host(), self.ux.copy_to_host(), self.uy.copy_to_host()
+        event, (rho, ux, uy) = self.compute_macroscopic_async()
+        event.synchronize()
+        return rho.copy(), ux.copy(), uy.copy()
 
 def main():
     import time
@@ -295,6 +607,9 @@ def main():
     # Set mask
     solver.set_mask()
 
+    # Pick the fastest thread-block shape for this device and grid
+    solver.autotune_blockdim()
+
     nsteps = 10000
     t0 = time.time()
     solver.run(nsteps)
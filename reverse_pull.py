@@ -1,4 +1,4 @@
-from diffusion import streaming_kernel_periodic, idx, cx_const, cy_const
+from diffusion import streaming_kernel_periodic, idx, cx_const, cy_const, wrap
 import numpy as np
 from numba import cuda
 
@@ -9,8 +9,8 @@ def streaming_kernel_periodic_reverse(f_in, f_out, nx, ny):
     if i < nx and j < ny:
         for k in range(9):
             # Periodic boundary conditions
-            ip = (i - cx_const[k] + nx) % nx
-            jp = (j - cy_const[k] + ny) % ny
+            ip = wrap(i - cx_const[k], nx)
+            jp = wrap(j - cy_const[k], ny)
             f_out[idx(ip, jp, k, nx, ny)] = f_in[idx(i, j, k, nx, ny)]
 
 if __name__ == "__main__":